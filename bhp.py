@@ -28,18 +28,29 @@ be copy/pasted to any project or personal script.
 from __future__ import print_function
 from tmpdir.functions import pr_begin, pr_end, pr_info, pr_warn, pr_error
 from tmpdir.functions import pr_die, eval_colors, mount_info, sigwinch_handler
-import os, os.path, signal, sys, tempfile, tmpdir
+import atexit, json, os, os.path, re, signal, stat, sys, tempfile, time, tmpdir
+import tmpdir.stage
 
 bhp_info = dict({})
 bhp_info['zero'] = os.path.basename(sys.argv[0])
 
-HELP_MESSAGE = 'Usage: %s [OPTIONS] [BROWSER]' % bhp_info['zero']
+HELP_MESSAGE = 'Usage: %s [OPTIONS] [BROWSER]\n' % bhp_info['zero']
+HELP_MESSAGE += '       %s list|verify ARCHIVE [PATH...]\n' % bhp_info['zero']
+HELP_MESSAGE += '       %s [-t DIR] extract ARCHIVE PATH...' % bhp_info['zero']
 HELP_MESSAGE += """
     -c, --compressor 'lzop -1'   Use lzop compressor (default to lz4)
+    -f, --format seekable        Use seekable archives (default to tar)
     -d, --daemon 300             Sync time (in sec) when daemonized
+    -i, --idle 30                Sync when the browser is idle (in sec)
+    -T, --tier 86400             Keep files cold for (in sec) on disk
+    -S, --stage 256M             Stage tarballs in TMPDIR (memory cap) and write
+                                 them behind to disk
+    -Q, --queue 2                Staged tarballs queue depth (default to 2)
     -t, --tmpdir DIR             Set up a particular TMPDIR
     -p, --profiel PROFILE        Select a particular profile
     -s, --set                    Set up tarball archives
+    -w, --prewarm                Read the hot file set after restoring tarballs
+    -b, --bench                  Print timing and page cache counters
     -h, --help                   Print help message
     -v, --version                Print version message                    
 """
@@ -90,7 +101,7 @@ def mozilla_profile(browser, profile=''):
 def bhp(profile, setup=False):
     """Profile initializer function and temporary directories setup"""
     global TMPDIR, bhp
-    ext = '.tar.%s' % bhp_info['compressor'].split(' ')[0]
+    ext = tmpdir.archive_extension(bhp_info['compressor'], bhp_info['format'])
 
     #
     # Set up browser and/or profile directory
@@ -123,7 +134,7 @@ def bhp(profile, setup=False):
         os.chdir(os.path.dirname(dir))
 
         if not os.path.isfile(profile+ext) or not os.path.isfile(profile+'.old'+ext):
-            if os.system("tar -cpf {0} -I '{1}' {2}".format(profile+ext, bhp_info['compressor'], profile)):
+            if tmpdir.archive_pack(profile+ext, profile, bhp_info['compressor']):
                 pr_end(1, "Tarball")
                 continue
 
@@ -134,8 +145,8 @@ def bhp(profile, setup=False):
 
         if 'cache' in dir: char = 'c'
         else: char = 'b'
-        tmpdir = tempfile.mkdtemp(prefix='%{0}hp'.format(char), dir=TMPDIR)
-        if os.system('sudo  mount --bind %s %s' % (tmpdir, dir)):
+        tmp = tempfile.mkdtemp(prefix='%{0}hp'.format(char), dir=TMPDIR)
+        if os.system('sudo  mount --bind %s %s' % (tmp, dir)):
             pr_end(2, "Mounting")
             continue
         pr_end(0)
@@ -146,57 +157,331 @@ def bhp_archive(ext, profile):
     """Set up or (un)compress archive tarballs accordingly"""
     pr_begin("Setting up tarball... ")
     if os.path.isfile(profile+'/.unpacked'):
+        if bhp_info['prewarm']:
+            tmpdir.prewarm_record(profile, since=os.stat(profile+'/.unpacked').st_mtime)
+        if bhp_info['stage']:
+            if tmpdir.stage.stage_pack(profile+ext, profile, bhp_info['compressor'],
+                    exclude=profile+'/.unpacked', old=profile+'.old'+ext):
+                pr_end(1, "Staging")
+                return 2
+            pr_end(0)
+            return 0
         if os.path.isfile(profile+ext):
             try:
                 os.rename(profile+ext, profile+'.old'+ext)
             except OSError:
                 pr_end(1, "Moving")
                 return 1
-        if os.system("tar -X {0}/.unpacked -cpf {1} -I '{2}' {3}".format(
-            profile, profile+ext, bhp_info['compressor'], profile)):
+        if tmpdir.archive_pack(profile+ext, profile, bhp_info['compressor'],
+                               exclude=profile+'/.unpacked'):
             pr_end(1, "Packing")
             return 2
+        tmpdir.cache_drop(profile+ext)
     else:
         if   os.path.isfile(profile+ext       ): tarball = profile+ext
         elif os.path.isfile(profile+'.old'+ext): tarball = profile+'.old'+ext
         else:
             pr_warn("No tarball found.");
             return 3
-        if os.system("tar -xpf {0} -I '{1}'".format(tarball, bhp_info['compressor'])):
+        if tmpdir.archive_unpack(tarball, bhp_info['compressor']):
             pr_end(1, "Unpacking")
             return 4
         else:
             fh = open('{0}/.unpacked'.format(profile), "w")
             fh.close()
+        tmpdir.cache_drop(tarball, sync=0)
+        if bhp_info['prewarm']:
+            tmpdir.prewarm(profile)
+            # Hot file set cutoff (see prewarm_record()) after prewarm reads
+            os.utime('{0}/.unpacked'.format(profile), None)
 
     pr_end(0)
 
-def bhp_daemon(time=(60*5)):
-    """Simple function to handle syncing the tarball archive to disk"""
+def browser_pid(dir):
+    """Find the browser process holding a profile lock file (Mozilla lock symlink,
+    Chromium SingletonLock symlink or a process holding .parentlock open)"""
+    for lock in ['lock', 'SingletonLock']:
+        try:
+            pid = re.search(r'(\d+)$', os.readlink(os.path.join(dir, lock)))
+        except OSError:
+            continue
+        if pid and os.path.isdir('/proc/%s' % pid.group(1)):
+            return int(pid.group(1))
+
+    lock = os.path.join(dir, '.parentlock')
+    if not os.path.isfile(lock): return 0
+    for pid in filter(str.isdigit, os.listdir('/proc')):
+        try:
+            fds = os.listdir('/proc/%s/fd' % pid)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                if os.readlink('/proc/%s/fd/%s' % (pid, fd)) == lock:
+                    return int(pid)
+            except OSError:
+                continue
+    return 0
+
+def browser_pids(pid):
+    """Return a browser process and its descendant process IDs"""
+    children = dict({})
+    for child in filter(str.isdigit, os.listdir('/proc')):
+        try:
+            FILE = open('/proc/%s/stat' % child)
+            children.setdefault(FILE.read().rsplit(')', 1)[1].split()[1], []).append(child)
+            FILE.close()
+        except (IOError, IndexError):
+            continue
+    pids = [str(pid)]
+    for pid in pids: pids.extend(children.get(pid, []))
+    return pids
+
+def browser_files(pid=0):
+    """Return the set of files opened by a browser process and its descendants, or
+    by any process when pid is unknown (0)"""
+    files = set([])
+    for pid in browser_pids(pid) if pid else filter(str.isdigit, os.listdir('/proc')):
+        try:
+            fds = os.listdir('/proc/%s/fd' % pid)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                files.add(os.readlink('/proc/%s/fd/%s' % (pid, fd)))
+            except OSError:
+                continue
+    return files
+
+def profile_mtime(dirs):
+    """Return the newest modification time of regular files in dirs (browser write
+    activity; tmpfs writes are not accounted in /proc/<pid>/io write_bytes.) Files
+    written by this script (.unpacked, .tiering, prewarm trace) are ignored."""
+    mtime, skip = 0, ['.unpacked', '.tiering', tmpdir.PREWARM]
+    for dir in dirs:
+        for root, subdirs, names in os.walk(dir):
+            for name in names:
+                if name in skip: continue
+                try:
+                    st = os.lstat(os.path.join(root, name))
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode): mtime = max(mtime, st.st_mtime)
+    return mtime
+
+def bhp_sched(timeout=(60*5)):
+    """Sync scheduler: return True when the browser just exited, has been idle for
+    bhp_info['idle'] seconds after writing, or timeout seconds elapsed since last sync
+    (fallback for browsers never going idle or not detected)"""
+    sched, now = bhp_info['sched'], time.time()
+    pid = browser_pid(bhp_info['dirs'][0])
+
+    if sched['pid'] and sched['pid'] != pid:
+        pr_info("Browser (pid=%d) exited" % sched['pid'])
+        sched.update(pid=0, dirty=False, last=now)
+        return True
+    if pid:
+        mtime = profile_mtime(bhp_info['dirs'])
+        if sched['pid'] != pid:
+            sched.update(pid=pid, mtime=mtime, busy=now, dirty=True)
+        elif mtime > sched['mtime']:
+            sched.update(mtime=mtime, busy=now, dirty=True)
+        if sched['dirty'] and now-sched['busy'] >= bhp_info['idle']:
+            sched.update(dirty=False, last=now)
+            return True
+        sched['seen'] = True
+    elif sched['seen']:
+        return False
+
+    if (sched['dirty'] or not sched['seen']) and now-sched['last'] >= timeout:
+        sched.update(dirty=False, last=now)
+        return True
+    return False
+
+def tier_rel(dir, file):
+    """Return a path relative to dir of a file in dir or in its cold store (or None)"""
+    for root in [dir, dir+'.cold']:
+        if file.startswith(root+'/'): return os.path.relpath(file, root)
+    return None
+
+def tier_score(entry, now):
+    """Return the access frequency of a TIER entry: hits decayed by half every
+    bhp_info['tier_age'] seconds since the last hit"""
+    return entry[2]*0.5**((now-entry[3])/float(bhp_info['tier_age']))
+
+def tier_sample(dir, count=True, pid=0):
+    """Record per file access frequency of a directory and its cold subtrees: a hit
+    is an access or modification time change since the previous sample, or the
+    file being newly opened by the browser (pid, or any process if unknown) since
+    the previous sample. The latter is required with relatime mounts where atime
+    is updated once a day at most after mtime. count=False only update the
+    reference times (e.g. after reading files to archive them)"""
+    if dir not in bhp_info['tier']:
+        try:
+            bhp_info['tier'][dir] = json.load(open(os.path.join(dir, '.tiering')))
+        except (IOError, ValueError):
+            bhp_info['tier'][dir] = dict({})
+    TIER, now, seen = bhp_info['tier'][dir], time.time(), set([])
+    opened = set([])
+    if count:
+        files = set(tier_rel(dir, file) for file in browser_files(pid))
+        opened = files-bhp_info['tier_files'].get(dir, set([]))
+        bhp_info['tier_files'][dir] = files
+    for root, dirs, names in os.walk(dir, followlinks=True):
+        for name in names:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, dir)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            seen.add(rel)
+            if rel not in TIER:
+                TIER[rel] = [st.st_atime, st.st_mtime, 1, now]
+            elif count and (rel in opened or [st.st_atime, st.st_mtime] != TIER[rel][:2]):
+                TIER[rel] = [st.st_atime, st.st_mtime, tier_score(TIER[rel], now)+1, now]
+            else:
+                TIER[rel][:2] = [st.st_atime, st.st_mtime]
+    for rel in set(TIER)-seen: del TIER[rel]
+
+def tier_apply(dir):
+    """Keep cold files (access frequency below bhp_info['tier_hits'], see
+    tier_score()) or cold subtrees (see bhp_info['tier_dirs']) on disk behind
+    symlinks to <dir>.cold, and promote them back to the temporary directory when
+    they get hot again. Files opened by any process are left untouched (browser
+    detection only cover a few browsers, see browser_pid().) Cold
+    copies of promoted entries are kept until an archive is written (see
+    tier_purge()), so that the previous archive symlinks do not dangle."""
+    import shutil
+    TIER, now, cold = bhp_info['tier'].get(dir, {}), time.time(), dir+'.cold'
+    PURGE = bhp_info['tier_purge'].setdefault(dir, set([]))
+    demoted, promoted, size = 0, 0, 0
+
+    # Hot and busy paths along with their parent subtrees
+    HOT, BUSY = set([]), set([])
+    for (paths, rels) in [(HOT, [rel for rel in TIER if tier_score(TIER[rel], now) >=
+                                 bhp_info['tier_hits']]),
+                          (BUSY, [tier_rel(dir, file) for file in browser_files()])]:
+        for rel in rels:
+            while rel and rel not in paths:
+                paths.add(rel)
+                rel = os.path.dirname(rel)
+
+    for root, dirs, names in os.walk(dir):
+        for name in list(dirs)+names:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, dir)
+            store = os.path.join(cold, rel)
+            if os.path.islink(path):
+                if os.readlink(path) != store or rel not in HOT or rel in BUSY: continue
+                if os.path.isdir(store):
+                    shutil.copytree(store, path+'.~tier~', symlinks=True)
+                    os.unlink(path)
+                else:
+                    shutil.copy2(store, path+'.~tier~')
+                os.rename(path+'.~tier~', path)
+                PURGE.add(store)
+                promoted += 1
+                continue
+
+            if name in dirs:
+                if name not in bhp_info['tier_dirs']: continue
+                dirs.remove(name)
+            elif rel not in TIER or os.path.getsize(path) < bhp_info['tier_size']:
+                continue
+            if rel in HOT or rel in BUSY: continue
+            size += tmpdir.footprint(path) if os.path.isdir(path) else \
+                    os.path.getsize(path)
+            if store in PURGE:
+                tier_remove(store)
+                PURGE.discard(store)
+            if not os.path.isdir(os.path.dirname(store)):
+                os.makedirs(os.path.dirname(store))
+            shutil.move(path, store)
+            os.symlink(store, path)
+            demoted += 1
+
+    FILE = open(os.path.join(dir, '.tiering'), 'w')
+    json.dump(TIER, FILE)
+    FILE.close()
+    if demoted or promoted:
+        pr_info("%s: %d demoted (%dk), %d promoted" % (os.path.basename(dir),
+                demoted, size//1024, promoted))
+
+def tier_remove(path):
+    """Remove a cold store file or subtree"""
+    import shutil
+    if os.path.isdir(path) and not os.path.islink(path): shutil.rmtree(path)
+    elif os.path.lexists(path): os.unlink(path)
+
+def tier_purge(dir):
+    """Remove cold copies of promoted entries once an archive not referencing them
+    was written to disk (staged archives are flushed first)"""
+    PURGE = bhp_info['tier_purge'].get(dir)
+    if not PURGE: return
+    if bhp_info['stage'] and tmpdir.stage.stage_flush(): return
+    for store in list(PURGE):
+        tier_remove(store)
+        PURGE.discard(store)
+
+def bhp_daemon(timeout=(60*5)):
+    """Simple function to handle syncing the tarball archive to disk when the browser
+    is idle or exit (see bhp_sched())"""
+    timeout = int(timeout)
+    bhp_info['sched'] = dict(pid=0, mtime=0, busy=0, dirty=False, seen=False,
+                             last=time.time())
     while True:
-        signal.alarm(int(time))
-        signal.pause()
+        time.sleep(min(bhp_info['poll'], timeout))
+        if bhp_info['tier_age']:
+            for dir in bhp_info['dirs']:
+                tier_sample(dir, pid=bhp_info['sched']['pid'])
+        if bhp_sched(timeout): sigalrm_handler()
 
 def sigalrm_handler(sig=signal.SIGALRM, frame=None):
     for dir in bhp_info['dirs']:
         os.chdir(os.path.dirname(dir))
-        bhp_archive('.tar.%s' % bhp_info['compressor'].split(' ')[0],
-                bhp_info['profile'].split('/')[-1])
+        # Tier before packing for the archive to match the cold store
+        if bhp_info['tier_age']:
+            tier_apply(dir)
+        ret = bhp_archive(tmpdir.archive_extension(bhp_info['compressor'],
+                bhp_info['format']), bhp_info['profile'].split('/')[-1])
+        if bhp_info['tier_age']:
+            tier_sample(dir, count=False)
+            if not ret: tier_purge(dir)
+    if bhp_info['stage'] and bhp_info['bench']: tmpdir.stage.stage_stats()
+
+def sigterm_handler(sig=signal.SIGTERM, frame=None):
+    """Exit (flushing staged snapshots to disk, see bhp_flush())"""
+    sys.exit(0)
+
+def bhp_flush():
+    """Force flush of staged snapshots to disk (on shutdown)"""
+    if not bhp_info.get('stage'): return
+    pr_begin("Flushing staged tarballs... ")
+    pr_end(tmpdir.stage.stage_flush())
 signal.signal(signal.SIGALRM, sigalrm_handler)
 
 if __name__ == '__main__':
     bhp_info['browser'], bhp_info['compressor'] = '', 'lz4 -1'
     profile, setup, bhp_info['daemon'] = '', False, 0
-    TMPDIR = os.environ.get('TMPDIR', '/tmp/' + os.environ['USER'])
+    bhp_info['prewarm'], bhp_info['bench'], bhp_info['format'] = False, False, 'tar'
+    bhp_info['idle'], bhp_info['poll'] = 30, 10
+    bhp_info['tier'], bhp_info['tier_age'], bhp_info['tier_size'] = dict({}), 0, 1<<16
+    bhp_info['tier_dirs'] = ['storage', 'sessionstore-backups', 'OfflineCache']
+    bhp_info['tier_hits'], bhp_info['tier_files'] = 1, dict({})
+    bhp_info['tier_purge'] = dict({})
+    bhp_info['stage'] = False
+    TMPDIR, dest = os.environ.get('TMPDIR', '/tmp/' + os.environ['USER']), '.'
     tmpdir.functions.NAME = bhp_info['zero']
 
     #
     # Set up options according to command line options
     #
-    import getopt, re
-    shortopts = 'c:d:hp:st:v'
-    longopts  = ['compressor=', 'daemon=', 'help', 'profile=', 'set',
-            'tmpdir=', 'version']
+    import getopt
+    shortopts = 'bc:d:f:hi:p:Q:S:sT:t:vw'
+    longopts  = ['bench', 'compressor=', 'daemon=', 'format=', 'help', 'idle=',
+            'profile=', 'prewarm', 'queue=', 'set', 'stage=', 'tier=', 'tmpdir=',
+            'version']
     try:
         opts, args = getopt.getopt(sys.argv[1:], shortopts, longopts)
     except getopt.GetoptError:
@@ -212,22 +497,68 @@ if __name__ == '__main__':
             sys.exit(0)
         if opt in ['-c', '--compressor']:
             bhp_info['compressor'] = arg
+        if opt in ['-f', '--format']:
+            bhp_info['format'] = arg
         if opt in ['-p', '--profile']:
             profile = arg
         if opt in ['-s', '--set']:
             setup = True
         if opt in ['-t', '--tmpdir']:
-            TMPDIR = arg
-        if opt in ['-d', '--daemon=']:
+            TMPDIR = dest = arg
+        if opt in ['-d', '--daemon']:
             bhp_info['daemon'] = arg
+        if opt in ['-i', '--idle']:
+            bhp_info['idle'] = int(arg)
+        if opt in ['-S', '--stage']:
+            bhp_info['stage'] = True
+            tmpdir.stage.STAGE['cap'] = tmpdir.size_bytes(arg)
+        if opt in ['-Q', '--queue']:
+            tmpdir.stage.STAGE['depth'] = int(arg)
+        if opt in ['-T', '--tier']:
+            bhp_info['tier_age'] = int(arg)
+        if opt in ['-w', '--prewarm']:
+            bhp_info['prewarm'] = True
+        if opt in ['-b', '--bench']:
+            bhp_info['bench'] = True
         if opt in ['-C', '--noCOLOR']:
             PRINT_INFO['COLOR'] = 0
 
+    #
+    # Seekable archive subcommands
+    #
+    if args and args[0] in ['list', 'extract', 'verify']:
+        if len(args) < 2 or (args[0] == 'extract' and len(args) < 3):
+            print(HELP_MESSAGE)
+            sys.exit(1)
+        if not os.path.isfile(args[1]): pr_die(2, "No such archive: %s" % args[1])
+        if args[0] == 'list':
+            ret = tmpdir.archive.archive_list(args[1], args[2:])
+        elif args[0] == 'extract':
+            ret = tmpdir.archive.archive_extract(args[1], args[2:], dest=dest)
+        else:
+            ret = tmpdir.archive.archive_verify(args[1], args[2:])
+            if ret is not None:
+                for path in ret: pr_error("Corrupted entry: %s" % path)
+                ret = len(ret)
+            else: ret = -1
+        if ret < 0: pr_die(2, "Not a seekable archive: %s" % args[1])
+        sys.exit(0 if args[0] == 'list' else min(ret, 1))
+
     #
     # Finally, launch the setup helper
     #
     bhp_info['browser'] = args[0] or os.environ.get('BROWSER', '')
+    if bhp_info['stage']:
+        tmpdir.stage.STAGE['dir'] = TMPDIR
+        atexit.register(bhp_flush)
+        signal.signal(signal.SIGTERM, sigterm_handler)
+    if bhp_info['bench']:
+        start = time.time()
     bhp(profile=profile,setup=setup)
+    if bhp_info['bench']:
+        pr_info("setup: %.3fs" % (time.time()-start))
+        tmpdir.cache_stats()
+        if bhp_info['stage']: tmpdir.stage.stage_stats()
     if bhp_info['daemon']: bhp_daemon(bhp_info['daemon'])
 
 #
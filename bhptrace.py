@@ -0,0 +1,125 @@
+#!/usr/bin/python
+#
+# $Header: bhptrace.py                                        Exp $
+# $Author: (c) 2016 tokiclover <tokiclover@gmail.com>         Exp $
+# $License: MIT (or 2-clause/new/simplified BSD)              Exp $
+# $Version: 1.2 2016/03/18                                    Exp $
+#
+
+"""This utility record a web-browser session file operations on the profile and
+cache directories (bhp.py bind-mounted directories) into a compact trace file;
+and replay said traces on several temporary directory backends (tmpfs prefix
+from tmpdir_init(), zram device from zram_setup() or plain disk directory) to
+compare latency percentiles and throughput.
+
+Bundled synthetic traces (places, cache, session) can be replayed offline.
+"""
+
+from __future__ import print_function
+from tmpdir.functions import pr_die, pr_error, pr_info, sigwinch_handler
+from tmpdir.trace import trace_bundled, trace_record, trace_replay, trace_report
+import os, os.path, signal, sys, getopt, tmpdir
+
+zero = os.path.basename(sys.argv[0])
+tmpdir.functions.NAME = zero
+HELP_MESSAGE = 'Usage: %s [OPTIONS] record -o FILE DIR...\n' % zero
+HELP_MESSAGE += '       %s [OPTIONS] replay [TRACE...]' % zero
+HELP_MESSAGE += """
+  -o, --output=FILE                   Record trace to file
+  -p, --pid=PID                       Record a running process (strace -p)
+  -c, --command='firefox'             Record a command (instead of a process)
+  -b, --backend=disk:/var/tmp         Replay on a plain directory
+  -b, --backend=tmpfs:/mnt/bench      Replay on a tmpfs prefix (tmpdir_init())
+  -b, --backend='zram:1G ext4 /mnt/z' Replay on a zram device (zram_setup())
+  -S, --size=1G                       Setup tmpfs backend size (default to 50%)
+  -l, --list                          List bundled traces
+  -h, --help                          Print help message
+  -v, --version                       Print version message
+
+Examples:
+"""
+HELP_MESSAGE += '* `%s -p $(pidof -s firefox) -o ff.trace record ~/.mozilla/firefox/x.default\'\n' % zero
+HELP_MESSAGE += '* `%s -b disk:/var/tmp -b tmpfs:/mnt/bench replay\' to compare backends\n' % zero
+
+version = "1.2"
+VERSION_MESSAGE = '%s version %s' % (zero, version)
+
+signal.signal(signal.SIGWINCH, sigwinch_handler)
+
+def backend_setup(backend, size='50%'):
+    """Set up a replay backend; return the directory to replay on"""
+    kind, arg = (backend.split(':', 1)+[''])[:2]
+    if kind == 'disk':
+        dir = arg or os.environ.get('TMPDIR', '/var/tmp')
+    elif kind == 'tmpfs':
+        dir = arg
+        if not os.path.isdir(dir): os.makedirs(dir)
+        tmpdir.tmpdir_init(prefix=dir, size=size, saved=[])
+        if not os.path.ismount(dir): return None
+    elif kind == 'zram':
+        OPTS = arg.split()
+        if len(OPTS) < 3: return None
+        dir = OPTS[2]
+        if not os.path.ismount(dir) and tmpdir.zram_setup(device=arg): return None
+    else:
+        return None
+    return dir if os.path.isdir(dir) else None
+
+if __name__ == '__main__':
+    shortopts = 'b:c:hlo:p:S:v'
+    longopts  = ['backend=', 'command=', 'help', 'list', 'output=', 'pid=', 'size=',
+            'version']
+    try:
+        OPTS, ARGS = getopt.getopt(sys.argv[1:], shortopts, longopts)
+    except getopt.GetoptError:
+        print(HELP_MESSAGE)
+        sys.exit(1)
+
+    backends, output, pid, command, size = [], None, None, None, '50%'
+    for (opt, arg) in OPTS:
+        if opt in ['-h', '--help']:
+            print(HELP_MESSAGE)
+            sys.exit(0)
+        if opt in ['-v', '--version']:
+            print(VERSION_MESSAGE)
+            sys.exit(0)
+        if opt in ['-l', '--list']:
+            for name in trace_bundled(): print(name)
+            sys.exit(0)
+        if opt in ['-b', '--backend']:
+            backends.append(arg)
+        if opt in ['-c', '--command']:
+            command = arg.split()
+        if opt in ['-o', '--output']:
+            output = arg
+        if opt in ['-p', '--pid']:
+            pid = arg
+        if opt in ['-S', '--size']:
+            size = arg
+
+    if not ARGS or ARGS[0] not in ['record', 'replay']:
+        print(HELP_MESSAGE)
+        sys.exit(1)
+
+    if ARGS[0] == 'record':
+        if not output or not ARGS[1:] or not (pid or command):
+            pr_die(1, "Output file, directories and a process or command required")
+        num = trace_record(output, ARGS[1:], pid=pid, command=command)
+        pr_info("Recorded %d operations to %s" % (num, output))
+        sys.exit(0)
+
+    traces = ARGS[1:] or trace_bundled()
+    ret = 0
+    for backend in backends or ['disk:']:
+        dir = backend_setup(backend, size=size)
+        if not dir:
+            pr_error("Failed to set up %s backend" % backend)
+            ret += 1; continue
+        pr_info("Replaying on %s (%s)" % (backend, dir))
+        for trace in traces:
+            trace_report(os.path.basename(trace), trace_replay(trace, dir))
+    sys.exit(ret)
+
+#
+# vim:fenc=utf-8:ci:pi:sts=4:sw=4:ts=4:expandtab
+#
@@ -3,10 +3,11 @@ setup(
     name = "tmpdir",
     version = "1.2",
     packages = ['tmpdir'],
-    scripts = ['bhp.py', 'tmpdirs.py'],
+    scripts = ['bhp.py', 'bhptrace.py', 'tmpdirs.py'],
 
     package_data = {
         '': ['AUTHORS', 'COPYING', 'README.md', 'ChangeLog'],
+        'tmpdir': ['traces/*.trace'],
     },
     exclude_package_data = {
         'sh': [ '*.sh' ],
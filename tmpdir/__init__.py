@@ -38,15 +38,23 @@ Extra space efficiency can be atained by using zram which can be stacked with
 this type of usage.
 """
 
-from .functions import pr_begin, pr_die, pr_end, pr_info, pr_warn, mount_info, yesno
-import os, os.path, sys
+from .functions import pr_begin, pr_die, pr_end, pr_error, pr_info, pr_warn, mount_info, yesno
+from .functions import fadvise, page_cache
+from .archive import ARCHIVE, archive_append, archive_create, archive_extract
+from .archive import archive_rebase, archive_replay
+import os, os.path, sys, time, zlib
 
 __author__ = "tokiclover <tokiclover@gmail.com>"
 __date__ = "2016/03/20"
 __version__ = "1.2"
 
-TMPDIR = dict(compressor='lz4 -1', size='10%')
+TMPDIR = dict(compressor='lz4 -1', size='auto', fadvise=1, prewarm=0, margin=25,
+              size_min='64M', size_max='50%', watch=0, format='tar', append=0,
+              segments=ARCHIVE['segments'])
 ZRAM   = dict(compressor='lz4', streams=2, num_dev=4, boot_setup=0)
+CACHE  = dict(archives=0, archive_pages=0, archive_resident=0, prewarm_files=0,
+              prewarm_bytes=0, prewarm_pages=0, prewarm_hits=0)
+PREWARM = '.prewarm'
 
 def read_or_write(file, mode='r', *PARGS):
     """Tiny helper to read/write to file (echo and single file cat clone)"""
@@ -70,77 +78,325 @@ def read_or_write(file, mode='r', *PARGS):
         FILE.close()
         return PARGS
 
+#------------------------------------------------------ ARCHIVE FUNCTIONS
+def archive_extension(compressor=TMPDIR['compressor'], format=TMPDIR['format']):
+    """Return archive file extension of a format ('tar' or 'seekable')"""
+    if format == 'seekable': return ARCHIVE['extension']
+    return '.tar.'+compressor.split()[0]
+
+def archive_pack(file, dir, compressor=TMPDIR['compressor'], exclude=None):
+    """Pack a directory to a tarball or a seekable archive (by file extension)"""
+    if file.endswith(ARCHIVE['extension']):
+        try:
+            archive_create(file, dir, exclude=exclude)
+        except (IOError, OSError):
+            return 1
+        return 0
+    if exclude: exclude = '-X %s ' % exclude
+    return os.system("tar {0}-cpf {1} -I '{2}' {3}".format(exclude or '', file,
+                     compressor, dir))
+
+def archive_unpack(file, compressor=TMPDIR['compressor']):
+    """Unpack a tarball or a seekable archive (by file extension)"""
+    if file.endswith(ARCHIVE['extension']):
+        try:
+            return archive_extract(file) != 0
+        except (IOError, OSError, zlib.error):
+            return 1
+    return os.system("tar -xpf {0} -I '{1}'".format(file, compressor))
+
+#------------------------------------------------------ CACHE FUNCTIONS
+def cache_drop(file, sync=1):
+    """Drop an archive tarball from the page cache (after packing or unpacking) and
+    account the resident pages left behind in CACHE counters."""
+    if not os.path.isfile(file): return 1
+    ret = fadvise(file, sync=sync)
+    pages = page_cache(file)
+    CACHE['archives'] += 1
+    if pages:
+        CACHE['archive_resident'] += pages[0]
+        CACHE['archive_pages'] += pages[1]
+    return ret
+
+def prewarm_record(dir, since=0, trace=PREWARM):
+    """Record the hot file set of a directory, files accessed after since (epoch),
+    sorted by access time into an access-order trace file (relative paths.)"""
+    files = []
+    for root, dirs, names in os.walk(dir):
+        for name in names:
+            file = os.path.join(root, name)
+            if os.path.islink(file) or name == trace: continue
+            try:
+                atime = os.stat(file).st_atime
+            except OSError:
+                continue
+            if atime >= since:
+                files.append((atime, os.path.relpath(file, dir)))
+    files.sort()
+    FILE = open(os.path.join(dir, trace), 'w')
+    for (atime, file) in files: FILE.write("%s\n" % file)
+    FILE.close()
+    return 0
+
+def prewarm(dir, trace=PREWARM, bufsize=1<<20):
+    """Read the hot file set of a directory in access order (see prewarm_record())
+    to fault files in before first use; resident pages prior reading are accounted
+    as cache hits in CACHE counters."""
+    trace = os.path.join(dir, trace)
+    if not os.path.isfile(trace): return 1
+    FILE = open(trace, 'r')
+    for line in FILE:
+        file = os.path.join(dir, line.rstrip('\n'))
+        if not os.path.isfile(file): continue
+        pages = page_cache(file)
+        if pages:
+            CACHE['prewarm_hits'] += pages[0]
+            CACHE['prewarm_pages'] += pages[1]
+        try:
+            FH = open(file, 'rb')
+        except IOError:
+            continue
+        while True:
+            buf = FH.read(bufsize)
+            if not buf: break
+            CACHE['prewarm_bytes'] += len(buf)
+        FH.close()
+        CACHE['prewarm_files'] += 1
+    FILE.close()
+    return 0
+
+def cache_stats():
+    """Print page cache counters (see CACHE) gathered by cache_drop() and prewarm()"""
+    pr_info("archive: {archives} tarball(s), {archive_resident}/{archive_pages} pages "
+            "left in page cache".format(**CACHE))
+    pr_info("prewarm: {prewarm_files} file(s), {prewarm_bytes} bytes, "
+            "{prewarm_hits}/{prewarm_pages} pages cache hits".format(**CACHE))
+
+#------------------------------------------------------ SIZE FUNCTIONS
+def size_bytes(size):
+    """Convert a tmpfs like size (e.g. '512M', '2G', '10%' of RAM) to bytes"""
+    size = str(size).strip()
+    if size[-1:] == '%':
+        for line in open('/proc/meminfo'):
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1])*1024*int(size[:-1])//100
+        return 0
+    unit = dict(k=1<<10, m=1<<20, g=1<<30, t=1<<40).get(size[-1:].lower(), 1)
+    if unit > 1: size = size[:-1]
+    return int(size)*unit
+
+def archive_meta(file, **KARGS):
+    """Read (no keyword arguments) or write archive metadata (key=value file
+    alongside tarball archives.)
+
+    archive_meta('log.meta', size=1048576) # write footprint
+    archive_meta('log.meta')['size']       # read footprint"""
+    if KARGS:
+        FILE = open(file, 'w')
+        for key in sorted(KARGS): FILE.write("%s=%s\n" % (key, KARGS[key]))
+        FILE.close()
+        return 0
+    META = dict({})
+    if not os.path.isfile(file): return META
+    FILE = open(file, 'r')
+    for line in FILE:
+        if '=' in line:
+            key, val = line.rstrip('\n').split('=', 1)
+            META[key] = val
+    FILE.close()
+    return META
+
+def footprint(dir):
+    """Return the disk (tmpfs) usage of a directory in bytes (du(1) clone)"""
+    size = 0
+    for root, dirs, names in os.walk(dir):
+        for name in dirs+names:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_blocks*512
+            except OSError:
+                continue
+    return size
+
+def tmpdir_size(saved=None, margin=TMPDIR['margin'], size_min=TMPDIR['size_min'],
+        size_max=TMPDIR['size_max'], **KARGS):
+    """Compute a tmpfs size in bytes from the footprint of saved directories (read
+    from archive metadata) plus a growth margin (percent) within bounds.
+
+    tmpdir_size(saved=["/var/log"], margin=50, size_max="2G")"""
+    size = 0
+    for dir in saved or []:
+        META = archive_meta(dir+'.meta')
+        if 'size' in META:
+            size += int(META['size'])
+        elif os.path.isdir(dir):
+            size += footprint(dir)
+    size = size*(100+int(margin))//100
+    return max(size_bytes(size_min), min(size, size_bytes(size_max)))
+
+def tmpdir_resize(prefix, margin=TMPDIR['margin'], size_min=TMPDIR['size_min'],
+        size_max=TMPDIR['size_max'], high=90, low=40, **KARGS):
+    """Grow or shrink a tmpfs prefix online (remount) when its usage is above high
+    or below low (percent) water mark; new size is usage plus margin (percent)
+    within bounds. Return the new size in bytes or 0 if left untouched."""
+    if not os.path.ismount(prefix): return 0
+    st = os.statvfs(prefix)
+    total = st.f_blocks*st.f_frsize
+    used = (st.f_blocks-st.f_bfree)*st.f_frsize
+    if total and low*total <= 100*used <= high*total: return 0
+
+    size = used*(100+int(margin))//100
+    size = max(size_bytes(size_min), min(size, size_bytes(size_max)))
+    size = max(size, used+st.f_frsize)
+    if abs(size-total) < st.f_frsize: return 0
+    if os.system("mount -o remount,size={0}k {1}".format(size//1024, prefix)):
+        pr_error("Failed to resize %s" % prefix)
+        return 0
+    pr_info("Resized %s from %dk to %dk (%dk used)" % (prefix, total//1024,
+            size//1024, used//1024))
+    return size
+
+def tmpdir_watch(prefix, watch=60, **KARGS):
+    """Watch tmpfs prefix usage every watch seconds and resize it accordingly
+    (see tmpdir_resize() for the keyword arguments.) This never return, see
+    tmpdir_setup() for a background watcher."""
+    while True:
+        time.sleep(int(watch))
+        tmpdir_resize(prefix, **KARGS)
+
 #------------------------------------------------------ TMPDIR FUNCTIONS
 def tmpdir_init(prefix, compressor=TMPDIR['compressor'], size=TMPDIR['size'],
         saved=None, **KARGS):
     """Intialize a temporary directory hierarchy by mounting the prefix directory.
+    An 'auto' size is computed from saved directories footprint (see tmpdir_size().)
 
     tmpdir_init(prefix="/var/tmp", compressor="lz4 -1", saved=["/var/log"])"""
 
-    extension = compressor.split()[0]
-    for dir in saved:
-        if os.path.isfile("%s.%s" % (dir, extension)):
+    extension = archive_extension(compressor, KARGS.get('format', TMPDIR['format']))
+    for dir in saved or []:
+        if os.path.isfile(dir+extension) or os.path.isdir(dir+'.segments'):
             continue
         if os.path.isdir(dir):
-            tmpdir_save(dir, compressor=compressor)
+            tmpdir_save(dir, compressor=compressor, **KARGS)
         else:
             os.mkdir(dir, mode=755)
     if os.path.ismount(prefix): return 0
+    if size == 'auto':
+        size = "%dk" % (tmpdir_size(saved=saved, **KARGS)//1024)
+        pr_info("Sizing %s to %s" % (prefix, size))
     os.system("mount -o rw,nodev,mode=0755,size={0} -t tmpfs tmpdir {1}".format(
                size, prefix))
 
 def tmpdir_setup(prefix, compressor=TMPDIR['compressor'], size=TMPDIR['size'],
-        saved=None, unsaved=None):
+        saved=None, unsaved=None, **KARGS):
     """Setup a temporary directory hierarchy with optional tarball archives for entries
-    requiring state retention.
+    requiring state retention. A watch key start a background tmpdir_watch() process.
 
     tmpdir_setup(prefix="/var/test", compressor="lzop -1")"""
 
     if tmpdir_init(prefix=prefix, compressor=compressor, size=size, saved=saved,
-                   unsaved=unsaved):
+                   unsaved=unsaved, **KARGS):
         return 1
-    if not saved or not unsaved: return 0
 
-    for dir in (saved, unsaved):
-        DIR = "%s/%s".format(prefix, dir)
+    for dir in (saved or [])+(unsaved or []):
+        DIR = prefix+dir
         if os.path.ismount(DIR):
             continue
         if not os.path.isdir(DIR):
-            os.mkdir(DIR, mode=755)
+            os.makedirs(DIR, 0o755)
         pr_begin("Mounting %s" % DIR)
         ret = os.system("mount --bind {0} {1}".format(DIR, dir))
         pr_end(ret)
 
     if saved:
-        tmpdir_restore(saved, compressor=compressor)
-
-def tmpdir_restore(compressor=TMPDIR['compressor'], *PARGS):
-    """Restore temporary directory hierarchy from tarball archives."""
-    extension='.tar.'+compressor.split()[0]
-    for dir in PARGS:
+        tmpdir_restore(compressor=compressor, saved=saved, **KARGS)
+    if int(KARGS.get('watch', 0)):
+        # Watch in a background child process to not block (boot) callers
+        pid = os.fork()
+        if not pid:
+            os.setsid()
+            try:
+                tmpdir_watch(prefix, **KARGS)
+            finally:
+                os._exit(0)
+        pr_info("Watching %s (pid=%d)" % (prefix, pid))
+
+def tmpdir_restore(*PARGS, **KARGS):
+    """Restore temporary directory hierarchy from tarball archives (or append
+    segments, see tmpdir_save()); and optionaly read the hot file set (prewarm key)
+    afterwards.
+
+    tmpdir_restore("/var/log", compressor="lz4 -1", prewarm=1)"""
+    for key in TMPDIR:
+        KARGS[key] = KARGS.get(key, TMPDIR[key])
+    compressor = KARGS['compressor']
+    extensions = [archive_extension(compressor, format) for format in
+                  [KARGS['format']]+['tar', 'seekable']]
+    for dir in list(PARGS)+list(KARGS.get('saved') or []):
         os.chdir(os.path.dirname(dir))
-        tail = os.path.basename(dir)
-        if   os.path.isfile(tail+extension       ): tarball = tail+extension
-        elif os.path.isfile(tail+'.old'+extension): tarball = tail+'.old'+extension
+        tail, tarball = os.path.basename(dir), None
+        for extension in extensions:
+            if   os.path.isfile(tail+extension       ): tarball = tail+extension
+            elif os.path.isfile(tail+'.old'+extension): tarball = tail+'.old'+extension
+            if tarball: break
+        if os.path.isdir(tail+'.segments') and (yesno(KARGS['append']) or not tarball):
+            pr_begin("Restoring %s" % dir)
+            try:
+                ret = archive_replay(tail+'.segments')
+            except (IOError, OSError, zlib.error):
+                ret = 1
+            pr_end(ret)
+            if not ret: archive_rebase(tail+'.segments')
         else:
-            pr_warn("No tarball found.");
-            return 3
-        pr_begin("Restoring %s" % dir)
-        ret = os.system("tar -xpf {0} -I {1}".format(tarball, compressor))
-        pr_end(ret)
-
-def tmpdir_save(compressor=TMPDIR['compressor'], *PARGS):
-    """Save temporary directory hierarchy to disk."""
-    extension='.tar.'+compressor.split()[0]
-    for dir in PARGS:
+            if not tarball:
+                pr_warn("No tarball found.");
+                return 3
+            pr_begin("Restoring %s" % dir)
+            ret = archive_unpack(tarball, compressor)
+            pr_end(ret)
+            if yesno(KARGS['fadvise']): cache_drop(tarball, sync=0)
+        if not ret and yesno(KARGS['prewarm']): prewarm(dir)
+        if not ret:
+            META = archive_meta(tail+'.meta')
+            META['restored'] = time.time()
+            archive_meta(tail+'.meta', **META)
+
+def tmpdir_save(*PARGS, **KARGS):
+    """Save temporary directory hierarchy to disk; and drop the tarball archives
+    from the page cache (fadvise key.) Log-style directories can be saved in append
+    mode (append key) to <dir>.segments: only data appended since the previous save
+    is written, see archive_append().
+
+    tmpdir_save("/var/log", compressor="lz4 -1", append=1)"""
+    for key in TMPDIR:
+        KARGS[key] = KARGS.get(key, TMPDIR[key])
+    compressor = KARGS['compressor']
+    extension = archive_extension(compressor, KARGS['format'])
+    for dir in list(PARGS)+list(KARGS.get('saved') or []):
         os.chdir(os.path.dirname(dir))
         tail = os.path.basename(dir)
+        if yesno(KARGS['append']):
+            archive_meta(tail+'.meta', size=footprint(tail))
+            pr_begin("Saving %s" % dir)
+            try:
+                segment, size = archive_append(tail+'.segments', tail,
+                                               segments=int(KARGS['segments']))
+                ret = 0
+            except (IOError, OSError, ValueError):
+                ret = 1
+            pr_end(ret, "" if ret else "%d bytes" % size)
+            if not ret and yesno(KARGS['fadvise']): cache_drop(segment)
+            continue
+        # Hot file set: files accessed since the previous save (or restore)
+        since = float(archive_meta(tail+'.meta').get('restored', 0))
         if   os.path.isfile(tail+extension):
-            os.path.rename(tail+extension, tail+'.old'+extension)
+            since = max(since, os.stat(tail+extension).st_mtime)
+            os.rename(tail+extension, tail+'.old'+extension)
+        if yesno(KARGS['prewarm']): prewarm_record(dir, since=since)
+        archive_meta(tail+'.meta', size=footprint(tail))
         pr_begin("Saving %s" % dir)
-        ret = os.system("tar -cpf {0} -I {1} {2}".format(tail+extension,
-                         compressor, tail))
+        ret = archive_pack(tail+extension, tail, compressor)
         pr_end(ret)
+        if yesno(KARGS['fadvise']): cache_drop(tail+extension)
 
 #------------------------------------------------------ ZRAM FUNCTIONS
 def zram_reset(*PARGS):
@@ -229,8 +485,8 @@ def zram_setup(device, **KARGS):
         ret = os.system("mkfs -t {0} {1}".format(OPTS['fs'], dev))
         pr_end(ret)
 
-        if not ret and os.path.isdir(OPTS['dir']):
-            os.mkdir(dir, mode=755)
+        if not ret and OPTS.get('dir', ''):
+            if not os.path.isdir(OPTS['dir']): os.makedirs(OPTS['dir'], 0o755)
             mount_opts = "-t {0}".format(OPTS['fs'])
 
             if OPTS.get('opt', ''):
@@ -0,0 +1,406 @@
+#
+# $Header: tmpdir/archive.py                                  Exp $
+# $Author: (c) 2016 tokiclover <tokiclover@gmail.com>         Exp $
+# $License: MIT (or 2-clause/new/simplified BSD)              Exp $
+# $Version: 1.2 2016/03/18                                    Exp $
+#
+
+"""Seekable archive functions
+
+Archive made of independently (zlib) compressed frames followed by a trailing
+index mapping each path to its frames (offset, compressed size), size and
+checksum (crc32); so that listing, extracting or verifying a single path only
+touch the index and the frames of said path.
+
+    archive_create('profile.bhpa', 'profile')           # archive a directory
+    archive_list('profile.bhpa')                        # print archive content
+    archive_extract('profile.bhpa', ['profile/places.sqlite'])
+    archive_verify('profile.bhpa')                      # return corrupted entries
+
+Append segments (log-style directories) are seekable archives saving only the
+appended tail of files (entry offset) since the previous segment:
+
+    archive_append('log.segments', 'log')               # save appended data
+    archive_replay('log.segments')                      # restore log directory
+    archive_rebase('log.segments')                      # and update inodes
+
+Layout: MAGIC, frames..., zlib compressed JSON index, TRAILER (index offset,
+index length, INDEX magic.)
+"""
+
+from __future__ import print_function
+import json, os, os.path, stat, struct, zlib
+
+__author__ = "tokiclover <tokiclover@gmail.com>"
+__date__ = "2016/03/18"
+__version__ = "1.2"
+
+MAGIC, INDEX = b'BHPA\x01', b'BHPI'
+TRAILER = '>QQ4s'
+ARCHIVE = dict(frame=1<<20, level=1, extension='.bhpa', segments=32, fingerprint=4096)
+
+def archive_create(file, dir, exclude=None, frame=ARCHIVE['frame'],
+        level=ARCHIVE['level']):
+    """Archive dir (relative to the current directory like tar(1)) to file; exclude
+    is an optional file listing paths to skip. Return the index."""
+    skip = set([])
+    if exclude and os.path.isfile(exclude):
+        skip = set(line.rstrip('\n') for line in open(exclude) if line.strip())
+
+    entries = []
+    FILE = open(file+'.tmp', 'wb')
+    try:
+        FILE.write(MAGIC)
+        for root, dirs, names in os.walk(dir):
+            dirs.sort()
+            links = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+            for name in [''] + sorted(names) + links:
+                path = os.path.join(root, name) if name else root
+                if path in skip or os.path.relpath(path, dir) in skip: continue
+                # Skip entries vanishing meanwhile (live directory) like tar(1)
+                try:
+                    st = os.lstat(path)
+                    entry = dict(path=path, mode=stat.S_IMODE(st.st_mode),
+                            uid=st.st_uid, gid=st.st_gid, mtime=int(st.st_mtime),
+                            size=0, crc=0, frames=[])
+                    if stat.S_ISDIR(st.st_mode):
+                        entry['type'] = 'd'
+                    elif stat.S_ISLNK(st.st_mode):
+                        entry.update(type='l', link=os.readlink(path))
+                    elif stat.S_ISREG(st.st_mode):
+                        entry['type'] = 'f'
+                        archive_write(FILE, path, entry, frame=frame, level=level)
+                    else:
+                        continue
+                except OSError:
+                    continue
+                entries.append(entry)
+        archive_close(FILE, file, entries)
+    except (IOError, OSError):
+        FILE.close()
+        if os.path.isfile(file+'.tmp'): os.unlink(file+'.tmp')
+        raise
+    return entries
+
+def archive_write(FILE, path, entry, offset=0, frame=ARCHIVE['frame'],
+        level=ARCHIVE['level']):
+    """Write compressed frames of a file (from offset) and update its entry"""
+    FH = open(path, 'rb')
+    FH.seek(offset)
+    while True:
+        buf = FH.read(frame)
+        if not buf: break
+        data = zlib.compress(buf, level)
+        entry['frames'].append([FILE.tell(), len(data)])
+        entry['crc'] = zlib.crc32(buf, entry['crc']) & 0xffffffff
+        entry['size'] += len(buf)
+        FILE.write(data)
+    FH.close()
+
+def archive_close(FILE, file, entries):
+    """Write the trailing index, and then, move the archive in place"""
+    index = zlib.compress(json.dumps(dict(version=1, entries=entries)).encode('utf-8'))
+    offset = FILE.tell()
+    FILE.write(index)
+    FILE.write(struct.pack(TRAILER, offset, len(index), INDEX))
+    FILE.close()
+    os.rename(file+'.tmp', file)
+
+def archive_index(file):
+    """Read the trailing index of an archive; return a list of entries or None if
+    the file is not a (valid) seekable archive."""
+    try:
+        FILE = open(file, 'rb')
+    except (IOError, OSError):
+        return None
+    try:
+        if FILE.read(len(MAGIC)) != MAGIC: return None
+        FILE.seek(-struct.calcsize(TRAILER), os.SEEK_END)
+        offset, length, magic = struct.unpack(TRAILER, FILE.read(struct.calcsize(TRAILER)))
+        if magic != INDEX: return None
+        FILE.seek(offset)
+        return json.loads(zlib.decompress(FILE.read(length)).decode('utf-8'))['entries']
+    except (IOError, OSError, ValueError, zlib.error):
+        return None
+    finally:
+        FILE.close()
+
+def archive_match(entries, paths=None):
+    """Filter entries matching paths (a path match itself and its children)"""
+    if not paths: return entries
+    paths = [path.rstrip('/') for path in paths]
+    return [entry for entry in entries if
+            [path for path in paths if entry['path'] == path or
+             entry['path'].startswith(path+'/')]]
+
+def archive_frames(FILE, entry):
+    """Yield uncompressed frames of a file entry"""
+    for (offset, length) in entry['frames']:
+        FILE.seek(offset)
+        yield zlib.decompress(FILE.read(length))
+
+def archive_safe(path, dest=None):
+    """Whether an index path is safe to extract (relative, without '..' component,
+    and without symlink parent in dest e.g. created by a previous entry)"""
+    if not path or os.path.isabs(path) or '..' in os.path.normpath(path).split(os.sep):
+        return False
+    if dest is None: return True
+    parent = os.path.dirname(os.path.normpath(path))
+    while parent:
+        if os.path.islink(os.path.join(dest, parent)): return False
+        parent = os.path.dirname(parent)
+    return True
+
+def archive_list(file, paths=None):
+    """Print archive entries (tar -tv like output); return the entry number"""
+    entries = archive_index(file)
+    if entries is None: return -1
+    entries = archive_match(entries, paths)
+    for entry in entries:
+        print("%s %04o %d/%d %12d %08x %s%s" % (entry['type'], entry['mode'],
+              entry['uid'], entry['gid'], entry['size'], entry['crc'], entry['path'],
+              ' -> '+entry['link'] if entry['type'] == 'l' else ''))
+    return len(entries)
+
+def archive_extract(file, paths=None, dest='.'):
+    """Extract entries matching paths (everything by default) to dest directory;
+    return the number of failed entries (checksum mismatch, corrupted frame or
+    unsafe path) or -1."""
+    entries = archive_index(file)
+    if entries is None: return -1
+    ret, dirs = 0, []
+    FILE = open(file, 'rb')
+    for entry in archive_match(entries, paths):
+        if not archive_safe(entry['path'], dest):
+            ret += 1; continue
+        path = os.path.join(dest, entry['path'])
+        if entry['type'] == 'd': dirs.append((path, entry))
+        ret += archive_extract_entry(FILE, entry, path)
+    FILE.close()
+    for (path, entry) in reversed(dirs): archive_attr(path, entry)
+    return ret
+
+def archive_extract_entry(FILE, entry, path):
+    """Extract a single entry to path; return 1 on checksum mismatch or corrupted
+    frame, else 0"""
+    parent = os.path.dirname(path)
+    if parent and not os.path.isdir(parent): os.makedirs(parent)
+    if entry['type'] == 'd':
+        if os.path.islink(path): os.unlink(path)
+        if not os.path.isdir(path): os.mkdir(path)
+        return 0
+    if os.path.lexists(path) and not os.path.isdir(path): os.unlink(path)
+    if entry['type'] == 'l':
+        os.symlink(entry['link'], path)
+        return 0
+    crc, FH = 0, open(path, 'wb')
+    try:
+        for buf in archive_frames(FILE, entry):
+            crc = zlib.crc32(buf, crc) & 0xffffffff
+            FH.write(buf)
+    except zlib.error:
+        crc = None
+    finally:
+        FH.close()
+    archive_attr(path, entry)
+    return int(crc != entry['crc'])
+
+#------------------------------------------------------ APPEND FUNCTIONS
+def archive_append(segdir, dir, frame=ARCHIVE['frame'], level=ARCHIVE['level'],
+        segments=ARCHIVE['segments']):
+    """Save appended data of dir (log-style directory) to a new segment (seekable
+    archive) of segdir: only the tail of files grown since the last segment is
+    saved (by inode, offset and fingerprint); rotated (inode change), truncated
+    or rewritten (fingerprint change e.g. copytruncate) files are saved from the
+    beginning, renamed files (e.g. log.1 to log.2) are recorded as such. A full
+    segment is written after segments number of segments. Return a tuple of
+    (segment file, saved bytes.)"""
+    if not os.path.isdir(segdir): os.makedirs(segdir)
+    SEGMENTS = sorted(name for name in os.listdir(segdir)
+                      if name.endswith(ARCHIVE['extension']))
+    state, file = dict({}), os.path.join(segdir, 'state')
+    if SEGMENTS and len(SEGMENTS) < segments and os.path.isfile(file):
+        state = json.load(open(file))
+    num = int(SEGMENTS[-1].split('.')[0])+1 if SEGMENTS else 0
+    segment = os.path.join(segdir, '%06d%s' % (num, ARCHIVE['extension']))
+
+    entries, renames, STATE, size = [], [], dict({}), 0
+    inodes = dict((state[path][0], path) for path in state)
+    FILE = open(segment+'.tmp', 'wb')
+    FILE.write(MAGIC)
+    for root, dirs, names in os.walk(dir):
+        dirs.sort()
+        for name in [''] + sorted(names):
+            path = os.path.join(root, name) if name else root
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            entry = dict(path=path, mode=stat.S_IMODE(st.st_mode), uid=st.st_uid,
+                    gid=st.st_gid, mtime=int(st.st_mtime), size=0, crc=0, frames=[],
+                    offset=0)
+            if stat.S_ISDIR(st.st_mode):
+                entry['type'] = 'd'
+            elif stat.S_ISLNK(st.st_mode):
+                entry.update(type='l', link=os.readlink(path))
+            elif stat.S_ISREG(st.st_mode):
+                entry['type'] = 'f'
+                ino, offset, crc = (state.get(path, [None, 0])+[None])[:3]
+                old = inodes.get(st.st_ino)
+                if ino != st.st_ino and old and old != path and \
+                        (not os.path.lexists(old) or os.lstat(old).st_ino != st.st_ino):
+                    renames.append(dict(path=path, type='n', link=old))
+                    ino, offset, crc = (state[old]+[None])[:3]
+                same = ino == st.st_ino and st.st_size >= offset and \
+                    archive_fingerprint(path, offset) == crc
+                if same: entry['offset'] = offset
+                if same and st.st_size == offset:
+                    STATE[path] = [ino, offset, crc]
+                    continue
+                # Skip files vanishing meanwhile (e.g. rotated away)
+                try:
+                    archive_write(FILE, path, entry, offset=entry['offset'],
+                                  frame=frame, level=level)
+                    offset = entry['offset']+entry['size']
+                    STATE[path] = [st.st_ino, offset, archive_fingerprint(path, offset)]
+                except OSError:
+                    if renames and renames[-1]['path'] == path: renames.pop()
+                    STATE.pop(path, None)
+                    continue
+                size += entry['size']
+            else:
+                continue
+            entries.append(entry)
+    moved = set(entry['link'] for entry in renames)
+    for path in sorted(set(state)-set(STATE)-moved):
+        entries.append(dict(path=path, type='u'))
+    archive_close(FILE, segment, renames+entries)
+
+    FILE = open(file+'.tmp', 'w')
+    json.dump(STATE, FILE)
+    FILE.close()
+    os.rename(file+'.tmp', file)
+    if not state:
+        for name in SEGMENTS: os.unlink(os.path.join(segdir, name))
+    return (segment, size)
+
+def archive_fingerprint(path, offset, block=ARCHIVE['fingerprint']):
+    """Checksum the first and the last block before offset of a file (to detect
+    in place rewrites of saved data, whether the size changed or not)"""
+    FH = open(path, 'rb')
+    crc = zlib.crc32(FH.read(min(block, offset))) & 0xffffffff
+    FH.seek(max(0, offset-block))
+    crc = zlib.crc32(FH.read(offset-FH.tell()), crc) & 0xffffffff
+    FH.close()
+    return crc
+
+def archive_replay(segdir, dest='.'):
+    """Restore a directory from append segments (see archive_append()); return the
+    number of failed entries or -1."""
+    if not os.path.isdir(segdir): return -1
+    ret = 0
+    for name in sorted(os.listdir(segdir)):
+        if not name.endswith(ARCHIVE['extension']): continue
+        segment = os.path.join(segdir, name)
+        entries = archive_index(segment)
+        if entries is None: return -1
+        renames = []
+        for entry in entries:
+            if entry['type'] != 'n': continue
+            if not archive_safe(entry['path'], dest) or \
+                    not archive_safe(entry['link'], dest):
+                ret += 1; continue
+            try:
+                os.rename(os.path.join(dest, entry['link']),
+                          os.path.join(dest, entry['link']+'.~rename~'))
+                renames.append(entry)
+            except OSError:
+                ret += 1
+        for entry in renames:
+            try:
+                os.rename(os.path.join(dest, entry['link']+'.~rename~'),
+                          os.path.join(dest, entry['path']))
+            except OSError:
+                ret += 1
+        FILE = open(segment, 'rb')
+        for entry in entries:
+            path = os.path.join(dest, entry['path'])
+            if entry['type'] == 'n': continue
+            if not archive_safe(entry['path'], dest):
+                ret += 1; continue
+            if entry['type'] == 'u':
+                if os.path.lexists(path): os.unlink(path)
+                continue
+            if entry['type'] != 'f' or entry['offset'] == 0:
+                ret += archive_extract_entry(FILE, entry, path)
+                continue
+            if os.path.islink(path):
+                ret += 1; continue
+            crc, FH = 0, open(path, 'r+b' if os.path.isfile(path) else 'wb')
+            FH.seek(entry['offset'])
+            try:
+                for buf in archive_frames(FILE, entry):
+                    crc = zlib.crc32(buf, crc) & 0xffffffff
+                    FH.write(buf)
+                FH.truncate()
+            except zlib.error:
+                crc = None
+            finally:
+                FH.close()
+            if crc != entry['crc']: ret += 1
+            archive_attr(path, entry)
+        FILE.close()
+    return ret
+
+def archive_rebase(segdir, dest='.'):
+    """Update append state inode numbers (see archive_append()) after restoring a
+    directory with archive_replay(), e.g. to a new tmpfs; otherwise, the next
+    segment would save every file from the beginning. Return 0 on success."""
+    file = os.path.join(segdir, 'state')
+    if not os.path.isfile(file): return 1
+    state = json.load(open(file))
+    for path in list(state):
+        try:
+            st = os.lstat(os.path.join(dest, path))
+        except OSError:
+            del state[path]
+            continue
+        state[path][0] = st.st_ino
+    FILE = open(file+'.tmp', 'w')
+    json.dump(state, FILE)
+    FILE.close()
+    os.rename(file+'.tmp', file)
+    return 0
+
+def archive_attr(path, entry):
+    """Restore mode, ownership (when permitted) and mtime of an extracted entry"""
+    try:
+        os.chown(path, entry['uid'], entry['gid'])
+    except OSError:
+        pass
+    os.chmod(path, entry['mode'])
+    os.utime(path, (entry['mtime'], entry['mtime']))
+
+def archive_verify(file, paths=None):
+    """Verify checksum of entries matching paths (everything by default); return
+    the list of corrupted entry paths or None if not a seekable archive."""
+    entries = archive_index(file)
+    if entries is None: return None
+    bad = []
+    FILE = open(file, 'rb')
+    for entry in archive_match(entries, paths):
+        if entry['type'] != 'f': continue
+        crc, size = 0, 0
+        try:
+            for buf in archive_frames(FILE, entry):
+                crc = zlib.crc32(buf, crc) & 0xffffffff
+                size += len(buf)
+        except zlib.error:
+            crc = None
+        if crc != entry['crc'] or size != entry['size']: bad.append(entry['path'])
+    FILE.close()
+    return bad
+
+#
+# vim:fenc=utf-8:ci:pi:sts=4:sw=4:ts=4:expandtab
+#
@@ -157,6 +157,57 @@ def mount_info(node, file='/proc/mounts', mode=None):
     FILE.close()
     return ret
 
+def fadvise(file, sync=1):
+    """Drop the page cache of a file (archive tarballs) to not evict hot data of
+    other applications; dirty pages are written out first when sync is set.
+
+    fadvise('profile.tar.lz4') # return 0 when the hint was given"""
+    if not hasattr(os, 'posix_fadvise'): return 1
+    try:
+        fd = os.open(file, os.O_RDONLY)
+    except OSError:
+        return 2
+    try:
+        if sync: os.fdatasync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        return 3
+    finally:
+        os.close(fd)
+    return 0
+
+def page_cache(file):
+    """Count resident page cache pages of a file with mincore(2); return a tuple of
+    (resident, total) pages, or None if unsupported.
+
+    page_cache('places.sqlite') # (12, 1280) e.g. 12 pages out of 1280"""
+    try:
+        import ctypes, mmap
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.mmap.restype = ctypes.c_void_p
+        libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                ctypes.c_int, ctypes.c_int, ctypes.c_long]
+        libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+        libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    except (ImportError, OSError, AttributeError):
+        return None
+    size = os.path.getsize(file)
+    page = mmap.PAGESIZE
+    total = (size+page-1)//page
+    if not total: return (0, 0)
+
+    fd = os.open(file, os.O_RDONLY)
+    try:
+        addr = libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        if addr in [None, ctypes.c_void_p(-1).value]: return None
+        vec = (ctypes.c_ubyte*total)()
+        ret = libc.mincore(addr, size, vec)
+        libc.munmap(addr, size)
+    finally:
+        os.close(fd)
+    if ret: return None
+    return (sum(v & 1 for v in vec), total)
+
 def tput(cap, conv=0):
     """Simple helper to querry C<terminfo(5)> capabilities without a shell.
     Second argument enable integer conversion.
@@ -0,0 +1,187 @@
+#
+# $Header: tmpdir/stage.py                                    Exp $
+# $Author: (c) 2016 tokiclover <tokiclover@gmail.com>         Exp $
+# $License: MIT (or 2-clause/new/simplified BSD)              Exp $
+# $Version: 1.2 2016/03/18                                    Exp $
+#
+
+"""Snapshot staging with asynchronous write-behind functions
+
+Archive snapshots are first packed to a staging directory (a tmpfs or zram backed
+directory), which is fast and consistent; and then, a background writer flush
+them to their (disk) destination. Pending snapshots of the same destination are
+merged: only the newest one is written. Staging is bounded by a memory cap and a
+queue depth; snapshots are packed directly to their destination when staging
+is not possible (estimated from the previous snapshot size.)
+
+    STAGE.update(dir='/tmp/user', cap=256<<20, depth=2)
+    stage_pack('/home/user/.mozilla/firefox/x.tar.lz4', 'x', 'lz4 -1')
+    stage_flush()                           # force flush e.g. on shutdown
+    stage_stats()                           # print metrics
+"""
+
+from .functions import fadvise, pr_error, pr_info
+import os, os.path, shutil, tempfile, threading
+
+__author__ = "tokiclover <tokiclover@gmail.com>"
+__date__ = "2016/03/18"
+__version__ = "1.2"
+
+STAGE = dict(dir=tempfile.gettempdir(), cap=256<<20, depth=2, bytes=0, queue=0,
+             staged=0, merged=0, flushed=0, flushed_bytes=0, direct=0, errors=0)
+PENDING, ORDER, SIZES = dict({}), list([]), dict({})
+LOCK = threading.Condition()
+WRITER = dict(thread=None)
+
+def stage_pack(file, dir, compressor, exclude=None, old=None):
+    """Pack dir snapshot to a staging file and queue it for file destination (the
+    previous one is moved to old if any); pack directly to file when the memory
+    cap would be reached (estimated from the previous snapshot size.) Return 0 on
+    success."""
+    file = os.path.abspath(file)
+    if old: old = os.path.abspath(old)
+    estimate = SIZES.get(file) or (os.path.getsize(file) if os.path.isfile(file) else 0)
+
+    stage_writer()
+    LOCK.acquire()
+    try:
+        direct = STAGE['bytes']+estimate > int(STAGE['cap'])
+        # Write pending snapshots first to not be overwritten by an older one
+        while direct and (file in PENDING or STAGE.get('writing') == file):
+            LOCK.wait()
+    finally:
+        LOCK.release()
+    if direct: return stage_direct(file, dir, compressor, exclude, old)
+
+    from . import archive_pack
+    fd, staged = tempfile.mkstemp(prefix='.stage.', suffix=os.path.basename(file),
+                                  dir=STAGE['dir'])
+    os.close(fd)
+    if archive_pack(staged, dir, compressor, exclude=exclude):
+        os.unlink(staged)
+        return 1
+    size = SIZES[file] = os.path.getsize(staged)
+
+    LOCK.acquire()
+    try:
+        while file not in PENDING and len(PENDING) >= int(STAGE['depth']):
+            LOCK.wait()
+        # Merge with a pending snapshot, unless being written (left to the writer)
+        pending = PENDING.get(file)
+        writing = pending and pending[0] == STAGE.get('staged_file')
+        if pending and not writing:
+            os.unlink(pending[0])
+            STAGE['bytes'] -= pending[1]
+            STAGE['merged'] += 1
+            del PENDING[file]
+            ORDER.remove(file)
+        direct = STAGE['bytes']+size > int(STAGE['cap'])
+        if direct:
+            while STAGE.get('writing') == file: LOCK.wait()
+        else:
+            if file not in ORDER: ORDER.append(file)
+            PENDING[file] = (staged, size, old)
+            STAGE['bytes'] += size
+            STAGE['staged'] += 1
+        STAGE['queue'] = len(PENDING)
+        LOCK.notify_all()
+    finally:
+        LOCK.release()
+
+    if direct:
+        STAGE['direct'] += 1
+        return stage_write(file, staged, size, old)
+    return 0
+
+def stage_direct(file, dir, compressor, exclude=None, old=None):
+    """Pack dir snapshot directly to its destination (previous one kept as old)"""
+    from . import archive_pack
+    tmp = os.path.join(os.path.dirname(file), '.stage.'+os.path.basename(file))
+    STAGE['direct'] += 1
+    try:
+        if archive_pack(tmp, dir, compressor, exclude=exclude):
+            raise OSError("failed to pack %s" % dir)
+        fadvise(tmp)
+        size = SIZES[file] = os.path.getsize(tmp)
+        if old and os.path.isfile(file): os.rename(file, old)
+        os.rename(tmp, file)
+    except (IOError, OSError) as err:
+        STAGE['errors'] += 1
+        pr_error("Failed to write %s: %s" % (file, err))
+        if os.path.isfile(tmp): os.unlink(tmp)
+        return 1
+    STAGE['flushed'] += 1
+    STAGE['flushed_bytes'] += size
+    return 0
+
+def stage_write(file, staged, size, old=None):
+    """Move a staged snapshot to its destination (previous one kept as old)"""
+    try:
+        shutil.copyfile(staged, file+'.tmp')
+        fadvise(file+'.tmp')
+        if old and os.path.isfile(file): os.rename(file, old)
+        os.rename(file+'.tmp', file)
+    except (IOError, OSError) as err:
+        STAGE['errors'] += 1
+        pr_error("Failed to write %s: %s" % (file, err))
+        return 1
+    finally:
+        if os.path.isfile(staged): os.unlink(staged)
+    STAGE['flushed'] += 1
+    STAGE['flushed_bytes'] += size
+    return 0
+
+def stage_writer():
+    """Start the background writer thread (if not running)"""
+    if WRITER['thread'] and WRITER['thread'].is_alive(): return
+    WRITER['thread'] = threading.Thread(target=stage_loop, name='stage-writer')
+    WRITER['thread'].daemon = True
+    WRITER['thread'].start()
+
+def stage_loop():
+    """Background writer: flush pending snapshots in queued order"""
+    while True:
+        LOCK.acquire()
+        try:
+            while not ORDER: LOCK.wait()
+            file = ORDER[0]
+            staged, size, old = PENDING[file]
+            STAGE['writing'], STAGE['staged_file'] = file, staged
+        finally:
+            LOCK.release()
+
+        stage_write(file, staged, size, old)
+
+        LOCK.acquire()
+        try:
+            # A newer snapshot may have been merged while writing
+            if PENDING.get(file, (None,))[0] == staged:
+                del PENDING[file]
+                ORDER.remove(file)
+            STAGE['bytes'] -= size
+            STAGE['queue'] = len(PENDING)
+            STAGE['writing'] = STAGE['staged_file'] = None
+            LOCK.notify_all()
+        finally:
+            LOCK.release()
+
+def stage_flush():
+    """Wait for pending snapshots to be written (e.g. on shutdown)"""
+    LOCK.acquire()
+    try:
+        if ORDER: stage_writer()
+        while ORDER or STAGE.get('writing'): LOCK.wait()
+    finally:
+        LOCK.release()
+    return STAGE['errors']
+
+def stage_stats():
+    """Print staging metrics (see STAGE)"""
+    pr_info("stage: {queue}/{depth} queued, {bytes}/{cap} bytes staged, {staged} "
+            "staged, {merged} merged, {direct} direct".format(**STAGE))
+    pr_info("stage: {flushed} flushed ({flushed_bytes} bytes), {errors} error(s)"
+            .format(**STAGE))
+
+#
+# vim:fenc=utf-8:ci:pi:sts=4:sw=4:ts=4:expandtab
+#
@@ -0,0 +1,299 @@
+#
+# $Header: tmpdir/trace.py                                    Exp $
+# $Author: (c) 2016 tokiclover <tokiclover@gmail.com>         Exp $
+# $License: MIT (or 2-clause/new/simplified BSD)              Exp $
+# $Version: 1.2 2016/03/18                                    Exp $
+#
+
+"""Filesystem trace capture and replay functions
+
+Record file operations of a (browser) process on a few directories with strace(1)
+into a compact trace file; and then, replay said trace on a temporary directory
+backend (tmpfs, zram or plain disk directory) to compare latency and throughput.
+
+    trace_record('firefox.trace', dirs=['/home/user/.mozilla/firefox/x.default'],
+                 pid=1234)                  # record until interrupted
+    trace_replay('places', '/var/tmp')      # replay a (bundled) trace
+
+Trace file format is line oriented (paths are relative to the recorded directory
+parents, white spaces and '%' are escaped as '%XX' e.g. 'Local%20Storage/x'):
+
+    o PATH                  open (create) a file
+    r PATH SIZE             read  SIZE bytes at current file offset
+    w PATH SIZE             write SIZE bytes at current file offset
+    R PATH OFFSET SIZE      read  SIZE bytes at OFFSET (pread)
+    W PATH OFFSET SIZE      write SIZE bytes at OFFSET (pwrite)
+    s PATH                  fsync a file
+    t PATH SIZE             truncate a file
+    u PATH                  unlink a file
+    m PATH                  make a directory
+    n PATH NEW              rename a file
+"""
+
+from __future__ import print_function
+from .functions import fadvise
+import os, os.path, re, shutil, subprocess, tempfile, time
+
+__author__ = "tokiclover <tokiclover@gmail.com>"
+__date__ = "2016/03/18"
+__version__ = "1.2"
+
+TRACE = dict(dir=os.path.join(os.path.dirname(__file__), 'traces'),
+             extension='.trace', block=1<<16)
+SYSCALLS = ['open', 'openat', 'read', 'pread64', 'write', 'pwrite64', 'fsync',
+            'fdatasync', 'ftruncate', 'unlink', 'unlinkat', 'rename', 'renameat',
+            'renameat2', 'mkdir', 'mkdirat']
+STRACE = re.compile(r'^(?:\[pid\s+)?\d*\]?\s*(\w+)\((.*)\)\s+=\s+(-?\d+)(?:<(.*)>)?')
+FD = re.compile(r'^-?\w+<(.*)>$')
+PID = re.compile(r'^\[pid\s+(\d+)\]\s*')
+RESUMED = re.compile(r'^<\.\.\. \w+ resumed>\s*')
+
+def trace_file(name):
+    """Resolve a trace name to a file (bundled traces can be named without path)"""
+    if os.path.isfile(name): return name
+    return os.path.join(TRACE['dir'], name+TRACE['extension'])
+
+def trace_quote(path):
+    """Escape white spaces and '%' of a trace path (see trace_unquote())"""
+    return re.sub(r'[%\s]', lambda match: '%%%02X' % ord(match.group()), path)
+
+def trace_unquote(path):
+    """Unescape a trace path (see trace_quote())"""
+    return re.sub(r'%([0-9A-Fa-f]{2})', lambda match: chr(int(match.group(1), 16)),
+                  path)
+
+def trace_bundled():
+    """Return bundled trace names"""
+    if not os.path.isdir(TRACE['dir']): return []
+    return sorted(name[:-len(TRACE['extension'])] for name in os.listdir(TRACE['dir'])
+                  if name.endswith(TRACE['extension']))
+
+#------------------------------------------------------ RECORD FUNCTIONS
+def strace_args(args):
+    """Split strace(1) syscall arguments at top level commas"""
+    ARGS, arg, depth, quote = [], '', 0, False
+    for (i, c) in enumerate(args):
+        if quote:
+            if c == '"' and args[i-1] != '\\': quote = False
+        elif c == '"': quote = True
+        elif c in '[{(': depth += 1
+        elif c in ']})': depth -= 1
+        elif c == ',' and not depth:
+            ARGS.append(arg.strip()); arg = ''
+            continue
+        arg += c
+    if arg.strip(): ARGS.append(arg.strip())
+    return ARGS
+
+def strace_path(arg, dirfd=None):
+    """Return an absolute path from a strace(1) -y string or fd argument"""
+    match = FD.match(arg)
+    if match: return match.group(1)
+    if not arg.startswith('"'): return None
+    path = arg.strip('"')
+    if not os.path.isabs(path):
+        match = FD.match(dirfd or '')
+        path = os.path.join(match.group(1) if match else os.getcwd(), path)
+    return os.path.normpath(path)
+
+def strace_join(line, pending):
+    """Join strace(1) -f lines of a syscall interrupted by another process (call
+    <unfinished ...> and <... call resumed> lines) per pid; pending is a dict of
+    unfinished calls. Return a complete line or None."""
+    match = PID.match(line)
+    pid, line = (match.group(1), line[match.end():]) if match else ('', line)
+    if line.rstrip().endswith('<unfinished ...>'):
+        pending[pid] = line.rstrip()[:-len('<unfinished ...>')]
+        return None
+    match = RESUMED.match(line)
+    if match:
+        if pid not in pending: return None
+        return pending.pop(pid)+line[match.end():]
+    return line
+
+def strace_parse(line, dirs):
+    """Convert a strace(1) -y output line to a trace line (or None)"""
+    match = STRACE.match(line)
+    if not match: return None
+    call, ARGS, ret, retpath = match.group(1), strace_args(match.group(2)), \
+        int(match.group(3)), match.group(4)
+    if ret < 0: return None
+
+    def rel(path):
+        for dir in dirs:
+            if path and (path == dir or path.startswith(dir+'/')):
+                return trace_quote(os.path.relpath(path, os.path.dirname(dir)))
+        return None
+
+    if call in ['open', 'openat']:
+        path = rel(retpath)
+        return path and 'o %s' % path
+    if call in ['mkdir', 'unlink']:
+        path = rel(strace_path(ARGS[0]))
+        return path and '%s %s' % (call[0] if call == 'mkdir' else 'u', path)
+    if call in ['mkdirat', 'unlinkat']:
+        path = rel(strace_path(ARGS[1], ARGS[0]))
+        if not path: return None
+        if call == 'unlinkat' and 'AT_REMOVEDIR' in ARGS[-1]: return None
+        return '%s %s' % ('m' if call == 'mkdirat' else 'u', path)
+    if call in ['rename', 'renameat', 'renameat2']:
+        if call == 'rename': old, new = strace_path(ARGS[0]), strace_path(ARGS[1])
+        else: old, new = strace_path(ARGS[1], ARGS[0]), strace_path(ARGS[3], ARGS[2])
+        old, new = rel(old), rel(new)
+        return old and new and 'n %s %s' % (old, new)
+
+    path = rel(strace_path(ARGS[0]))
+    if not path: return None
+    if call in ['fsync', 'fdatasync']: return 's %s' % path
+    if call == 'ftruncate': return 't %s %s' % (path, ARGS[1])
+    if not ret: return None
+    if call == 'read':     return 'r %s %d' % (path, ret)
+    if call == 'write':    return 'w %s %d' % (path, ret)
+    if call == 'pread64':  return 'R %s %s %d' % (path, ARGS[3], ret)
+    if call == 'pwrite64': return 'W %s %s %d' % (path, ARGS[3], ret)
+    return None
+
+def trace_record(file, dirs, pid=None, command=None):
+    """Record file operations of a process (pid) or a command (list) on dirs to a
+    trace file until the process exit or an interrupt; return the number of
+    recorded operations."""
+    dirs = [os.path.normpath(os.path.abspath(dir)) for dir in dirs]
+    STRACE = ['strace', '-f', '-y', '-qq', '-s', '0', '-e', 'trace='+','.join(SYSCALLS)]
+    if pid: STRACE += ['-p', str(pid)]
+    else:   STRACE += ['--']+list(command)
+    proc = subprocess.Popen(STRACE, stderr=subprocess.PIPE, universal_newlines=True)
+
+    num, FILE, pending = 0, open(file, 'w'), dict({})
+    FILE.write("# bhp trace v1: %s\n" % ' '.join(trace_quote(dir) for dir in dirs))
+    try:
+        for line in proc.stderr:
+            line = strace_join(line, pending)
+            op = line and strace_parse(line, dirs)
+            if op:
+                FILE.write(op+'\n')
+                num += 1
+    except KeyboardInterrupt:
+        proc.terminate()
+    proc.wait()
+    FILE.close()
+    return num
+
+#------------------------------------------------------ REPLAY FUNCTIONS
+def trace_read(file):
+    """Read a trace file; return a list of operation lists"""
+    ops, FILE = [], open(trace_file(file), 'r')
+    for line in FILE:
+        if line.startswith('#') or not line.strip(): continue
+        op = line.split()
+        op[1] = trace_unquote(op[1])
+        if op[0] == 'n': op[2] = trace_unquote(op[2])
+        ops.append(op)
+    FILE.close()
+    return ops
+
+def trace_preload(ops, dir):
+    """Create files read by a trace (at their read extent) before replaying it, and
+    drop them from the page cache to not measure cached reads"""
+    pos, size, block = dict({}), dict({}), os.urandom(TRACE['block'])
+    for op in ops:
+        if op[0] == 'o':
+            pos[op[1]] = 0
+        elif op[0] in 'rw':
+            pos[op[1]] = pos.get(op[1], 0)+int(op[2])
+            if op[0] == 'r': size[op[1]] = max(size.get(op[1], 0), pos[op[1]])
+        elif op[0] == 'R':
+            size[op[1]] = max(size.get(op[1], 0), int(op[2])+int(op[3]))
+    for path in size:
+        path, length = os.path.join(dir, path), size[path]
+        if not os.path.isdir(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+        FILE = open(path, 'wb')
+        while length > 0:
+            FILE.write(block[:min(length, len(block))])
+            length -= len(block)
+        FILE.close()
+        fadvise(path)
+
+def percentile(values, pct):
+    """Return the pct percentile of a sorted list"""
+    if not values: return 0
+    return values[min(len(values)-1, int(len(values)*pct/100.0))]
+
+def trace_replay(file, dir):
+    """Replay a trace in a temporary sub-directory of dir; return a statistic dict
+    (ops, bytes, time, ops/latency per operation type)"""
+    ops = trace_read(file)
+    root = tempfile.mkdtemp(prefix='bhp-replay.', dir=dir)
+    trace_preload(ops, root)
+    fds, block = dict({}), os.urandom(TRACE['block'])
+    STATS = dict(ops=0, bytes=0, time=0.0, latency=dict({}))
+
+    def fd(path):
+        if path not in fds:
+            parent = os.path.dirname(os.path.join(root, path))
+            if not os.path.isdir(parent): os.makedirs(parent)
+            fds[path] = os.open(os.path.join(root, path), os.O_RDWR|os.O_CREAT, 0o644)
+        return fds[path]
+
+    def write(fd, size, offset=None):
+        if offset is not None: os.lseek(fd, offset, os.SEEK_SET)
+        while size > 0:
+            size -= os.write(fd, block[:min(size, len(block))])
+
+    def read(fd, size, offset=None):
+        if offset is not None: os.lseek(fd, offset, os.SEEK_SET)
+        while size > 0:
+            buf = os.read(fd, min(size, TRACE['block']))
+            if not buf: break
+            size -= len(buf)
+
+    def close(path):
+        if path in fds: os.close(fds.pop(path))
+
+    start = time.time()
+    for op in ops:
+        begin = time.time()
+        try:
+            if   op[0] == 'o': close(op[1]); fd(op[1])
+            elif op[0] == 'r': read(fd(op[1]), int(op[2]))
+            elif op[0] == 'w': write(fd(op[1]), int(op[2]))
+            elif op[0] == 'R': read(fd(op[1]), int(op[3]), int(op[2]))
+            elif op[0] == 'W': write(fd(op[1]), int(op[3]), int(op[2]))
+            elif op[0] == 's': os.fsync(fd(op[1]))
+            elif op[0] == 't': os.ftruncate(fd(op[1]), int(op[2]))
+            elif op[0] == 'u': close(op[1]); os.unlink(os.path.join(root, op[1]))
+            elif op[0] == 'm':
+                if not os.path.isdir(os.path.join(root, op[1])):
+                    os.makedirs(os.path.join(root, op[1]))
+            elif op[0] == 'n':
+                close(op[1]); close(op[2])
+                parent = os.path.dirname(os.path.join(root, op[2]))
+                if not os.path.isdir(parent): os.makedirs(parent)
+                os.rename(os.path.join(root, op[1]), os.path.join(root, op[2]))
+            else: continue
+        except OSError:
+            continue
+        STATS['latency'].setdefault(op[0], []).append(time.time()-begin)
+        STATS['ops'] += 1
+        if op[0] in 'rwRW': STATS['bytes'] += int(op[-1])
+    for path in list(fds): close(path)
+    STATS['time'] = time.time()-start
+
+    shutil.rmtree(root, ignore_errors=True)
+    for key in STATS['latency']: STATS['latency'][key].sort()
+    return STATS
+
+def trace_report(name, STATS):
+    """Print a replay report: throughput and latency percentiles (usec)"""
+    mb = STATS['bytes']/float(1<<20)
+    print("%s: %d ops, %.1fMB in %.3fs, %.0f ops/s, %.1f MB/s" % (name, STATS['ops'],
+          mb, STATS['time'], STATS['ops']/(STATS['time'] or 1), mb/(STATS['time'] or 1)))
+    print("  %-2s %8s %10s %10s %10s %10s" % ('op', 'count', 'p50', 'p90', 'p99', 'max'))
+    for op in sorted(STATS['latency']):
+        lat = STATS['latency'][op]
+        print("  %-2s %8d %10.1f %10.1f %10.1f %10.1f" % (op, len(lat),
+              percentile(lat, 50)*1e6, percentile(lat, 90)*1e6,
+              percentile(lat, 99)*1e6, lat[-1]*1e6))
+
+#
+# vim:fenc=utf-8:ci:pi:sts=4:sw=4:ts=4:expandtab
+#
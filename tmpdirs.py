@@ -18,8 +18,15 @@ HELP_MESSAGE += """
   -s, --zram-stream=4                 Setup ZRAM stream number per device (deafault to 2)
   -p, --tmpdir-prefix=/var/tmp        Setup temporary directory hierarchy
   -C, --tmpdir-compressor='lzop -1'   Setup tmpdir compressor (default to lz4)
+  -f, --tmpdir-format=seekable        Setup tmpdir archive format (default to tar)
   -t, --tmpdir-saved=/var/log         Setup archived temporary directory
+  -a, --tmpdir-append                 Save only appended data (log-style directory)
   -T, --tmpdir-unsaved=/var/run       Setup unarchived temporary directory
+  -S, --tmpdir-size=2G                Setup tmpfs size (default to auto)
+  -m, --tmpdir-margin=25              Setup auto size growth margin in percent
+  -l, --tmpdir-size-min=64M           Setup auto size lower bound
+  -L, --tmpdir-size-max=50%           Setup auto size upper bound
+  -w, --tmpdir-watch=60               Watch usage and resize tmpfs (in sec)
   -b, --boot                          Run subsystem initialization (kernel module)
   -h, --help                          Print help message
   -v, --version                       Print version message
@@ -40,10 +47,12 @@ if not len(sys.argv) > 1:
     print(HELP_MESSAGE)
     sys.exit(0)
 
-shortopts = 'bC:c:hs:T:t:p:vz:'
-longopts  = ['--boot', '--tmpdir-compressor=', '--zram-compressor=', '--zram-stream=',
-        '--tmpdir-prefix=', '--tmpdir-saved=', '--tmpdir-unsaved=', '--help',
-        '--version', '--zram-num-dev=']
+shortopts = 'abC:c:f:hL:l:m:S:s:T:t:p:vw:z:'
+longopts  = ['boot', 'tmpdir-compressor=', 'zram-compressor=', 'zram-stream=',
+        'tmpdir-prefix=', 'tmpdir-saved=', 'tmpdir-unsaved=', 'help',
+        'version', 'zram-num-dev=', 'tmpdir-size=', 'tmpdir-margin=',
+        'tmpdir-size-min=', 'tmpdir-size-max=', 'tmpdir-watch=', 'tmpdir-format=',
+        'tmpdir-append']
 
 try:
     OPTS, ARGS = getopt.getopt(sys.argv[1:], shortopts, longopts)
@@ -63,6 +72,8 @@ for (opt, arg) in OPTS:
         zram_ARGS['boot_setup'] = 1
     if opt in ['-C', '--tmpdir-compressor']:
         tmpdir_ARGS['compressor'] = arg
+    if opt in ['-f', '--tmpdir-format']:
+        tmpdir_ARGS['format'] = arg
     if opt in ['-c', '--zram-compressor']:
         zram_ARGS['compressor'] = arg
     if opt in ['-s', '--zram-stream']:
@@ -71,10 +82,22 @@ for (opt, arg) in OPTS:
         zram_ARGS['num_dev'] = arg
     if opt in ['-p', '--tmpdir-prefix']:
         tmpdir_ARGS['prefix'] = arg
+    if opt in ['-a', '--tmpdir-append']:
+        tmpdir_ARGS['append'] = 1
     if opt in ['-t', '--tmpdir-saved']:
         tmpdir_ARGS['saved'] = arg.split(',')
     if opt in ['-T', '--tmpdir-unsaved']:
         tmpdir_ARGS['unsaved'] = arg.split(',')
+    if opt in ['-S', '--tmpdir-size']:
+        tmpdir_ARGS['size'] = arg
+    if opt in ['-m', '--tmpdir-margin']:
+        tmpdir_ARGS['margin'] = arg
+    if opt in ['-l', '--tmpdir-size-min']:
+        tmpdir_ARGS['size_min'] = arg
+    if opt in ['-L', '--tmpdir-size-max']:
+        tmpdir_ARGS['size_max'] = arg
+    if opt in ['-w', '--tmpdir-watch']:
+        tmpdir_ARGS['watch'] = arg
 
 for arg in ARGS:
     tmpdir.zram_setup(device=arg, **zram_ARGS)